@@ -7,6 +7,7 @@ ensuring exactly 5 districts with 5 cells each.
 
 import numpy as np
 from collections import Counter
+from numba import njit
 import matplotlib.pyplot as plt
 from matplotlib.colors import ListedColormap
 
@@ -15,6 +16,53 @@ from matplotlib.colors import ListedColormap
 # 1. Find most common district assignment for each cell
 # ---------------------------------------------------------
 
+def build_neighbor_table(height, width):
+    """
+    Return an (height*width, 4) int32 table of 4-neighbors (N,S,W,E) for each
+    flat cell index, with -1 marking neighbors that fall off the grid.
+    """
+    idx = np.arange(height * width)
+    r, c = np.divmod(idx, width)
+    nbrs = np.full((height * width, 4), -1, dtype=np.int32)
+    nbrs[:, 0] = np.where(r > 0, idx - width, -1)
+    nbrs[:, 1] = np.where(r < height - 1, idx + width, -1)
+    nbrs[:, 2] = np.where(c > 0, idx - 1, -1)
+    nbrs[:, 3] = np.where(c < width - 1, idx + 1, -1)
+    return nbrs
+
+
+def build_neighbor_bits(nbrs):
+    """
+    Collapse a neighbor table into one uint64 bitmask per cell, with bit n set
+    when cell n is a 4-neighbor. Only valid for grids of at most 64 cells.
+    """
+    valid = nbrs >= 0
+    bits = np.left_shift(np.uint64(1), np.where(valid, nbrs, 0).astype(np.uint64))
+    return np.bitwise_or.reduce(np.where(valid, bits, np.uint64(0)), axis=1)
+
+
+# Neighbor table and bitmasks for the default 5x5 grid, built once at import
+NBRS = build_neighbor_table(5, 5)
+NBR_BITS = build_neighbor_bits(NBRS)
+
+
+def build_co_occurrence(flat):
+    """
+    Return the (n_cells, n_cells) matrix of how often each pair of cells shares
+    a district, for an (n_plans, n_cells) array of flat plan labels.
+
+    With H the one-hot (n_cells, n_plans * n_labels) indicator of every cell's
+    label in every plan, the counts are H @ H.T, a single BLAS matmul.
+    """
+    n_plans, n_cells = flat.shape
+    # Compact labels to 0..K-1 so the one-hot width is the number of labels used
+    labels, codes = np.unique(flat, return_inverse=True)
+    codes = codes.reshape(n_plans, n_cells)
+    onehot = (codes[:, :, None] == np.arange(len(labels))).astype(np.float32)
+    onehot = onehot.transpose(1, 0, 2).reshape(n_cells, -1)
+    return onehot @ onehot.T
+
+
 def build_consensus_map_by_modal_neighbors(plans, height=5, width=5, cells_per_district=5):
     """
     Build a label-invariant consensus district map from multiple 2D plans.
@@ -26,92 +74,204 @@ def build_consensus_map_by_modal_neighbors(plans, height=5, width=5, cells_per_d
     Enforces contiguity: each district is grown by only adding cells that are
     4-neighbors (N/S/E/W) of at least one cell already in the district.
     """
-    plans = [np.array(p) for p in plans]
     H, W = height, width
+
+    # Static 4-neighbor table (-1 = off-grid)
+    nbrs = NBRS if (H, W) == (5, 5) else build_neighbor_table(H, W)
     n_cells = H * W
-    n_plans = len(plans)
 
-    # Helper: convert between (row, col) and flat index
-    def rc_to_idx(r, c):
-        return r * W + c
+    # ----- 1. Build co-occurrence matrix (label-invariant similarity) -----
+    # np.asarray is a no-op for the ndarrays in Plans.py; stacking is the one copy
+    flat = np.stack([np.asarray(p).ravel() for p in plans])  # (n_plans, n_cells)
+    # Kept as exact counts rather than fractions of n_plans: the shared
+    # 1/n_plans factor cannot change which candidate wins. uint16 holds up to
+    # 65535 plans; larger ensembles switch to uint32 instead of wrapping
+    count_dtype = np.uint16 if len(flat) <= np.iinfo(np.uint16).max else np.uint32
+    co_occurrence = build_co_occurrence(flat).astype(count_dtype)
+
+    # ----- 2. Greedy clustering with contiguity constraint (compiled) -----
+    # Grids that fit in 64 cells track cell sets as single-word bitmasks
+    if n_cells <= 64:
+        nbr_bits = NBR_BITS if (H, W) == (5, 5) else build_neighbor_bits(nbrs)
+        district_labels = _consensus_bits_numba(co_occurrence, nbr_bits, cells_per_district)
+    else:
+        district_labels = _consensus_numba(co_occurrence, nbrs, cells_per_district)
+
+    # ----- 3. Reshape back to HxW grid -----
+    consensus_map = district_labels.reshape(H, W)
+    return consensus_map
 
-    def idx_to_rc(idx):
-        return divmod(idx, W)  # (row, col)
 
-    # Helper: 4-neighbors (N,S,E,W) of a flat index
-    def get_neighbors(idx):
-        r, c = idx_to_rc(idx)
-        nbrs = []
-        if r > 0:      nbrs.append(rc_to_idx(r - 1, c))
-        if r < H - 1:  nbrs.append(rc_to_idx(r + 1, c))
-        if c > 0:      nbrs.append(rc_to_idx(r, c - 1))
-        if c < W - 1:  nbrs.append(rc_to_idx(r, c + 1))
-        return nbrs
+@njit(cache=True)
+def _sum_co_occurrence(co_occurrence, cand, district, size):
+    """
+    Total co-occurrence count of `cand` with the first `size` district cells.
+    Every candidate in a growth step shares the same `size`, so ranking by this
+    sum picks the same cell as ranking by the average, without any division.
+    """
+    total = 0
+    for k in range(size):
+        total += co_occurrence[cand, district[k]]
+    return total
 
-    # ----- 1. Build co-occurrence matrix (label-invariant similarity) -----
-    co_occurrence = np.zeros((n_cells, n_cells), dtype=float)
 
-    for p in plans:
-        flat = p.flatten()
-        for i in range(n_cells):
-            for j in range(n_cells):
-                if flat[i] == flat[j]:
-                    co_occurrence[i, j] += 1.0
+@njit(cache=True)
+def _lowest_bit_index(bit):
+    """Index of the single set bit in a uint64 power of two."""
+    idx = 0
+    for shift in (32, 16, 8, 4, 2, 1):
+        if bit >> np.uint64(shift):
+            bit >>= np.uint64(shift)
+            idx += shift
+    return idx
+
 
-    co_occurrence /= n_plans  # convert to fraction of plans
+@njit(cache=True)
+def _best_candidate_bits(co_occurrence, candidates, district, size):
+    """
+    Highest-scoring cell among the set bits of `candidates` (-1 if none).
+    Bits are visited lowest first, so ties keep the lowest cell index.
+    """
+    best_cand = -1
+    best_score = -1
+    one = np.uint64(1)
+    while candidates:
+        rest = candidates & (candidates - one)
+        cand = _lowest_bit_index(candidates ^ rest)
+        candidates = rest
+        score = _sum_co_occurrence(co_occurrence, cand, district, size)
+        if score > best_score:
+            best_score = score
+            best_cand = cand
+    return best_cand
+
+
+@njit(cache=True)
+def _consensus_bits_numba(co_occurrence, nbr_bits, cells_per_district):
+    """
+    Bitmask variant of _consensus_numba for grids of at most 64 cells: the
+    assigned and frontier sets are uint64 words, so adding a cell's neighbors
+    is one OR and dropping assigned cells one AND-NOT.
+    """
+    n_cells = co_occurrence.shape[0]
+    one = np.uint64(1)
 
-    # ----- 2. Greedy clustering with contiguity constraint -----
-    assigned = np.zeros(n_cells, dtype=bool)
-    district_labels = np.full(n_cells, -1, dtype=int)
+    assigned = np.uint64(0)
+    district = np.empty(cells_per_district, dtype=np.int32)
+    district_labels = np.full(n_cells, -1, dtype=np.int32)
     current_label = 0
 
     for start_idx in range(n_cells):
-        if assigned[start_idx]:
+        start_bit = one << np.uint64(start_idx)
+        if assigned & start_bit:
             continue
 
         # Start a new district with this cell
-        district = [start_idx]
-        assigned[start_idx] = True
+        district[0] = start_idx
+        size = 1
+        assigned |= start_bit
         district_labels[start_idx] = current_label
+        frontier = nbr_bits[start_idx] & ~assigned
 
         # Grow district until we hit the required size
-        while len(district) < cells_per_district:
-            candidates = np.where(~assigned)[0]
+        while size < cells_per_district:
+            best_cand = _best_candidate_bits(co_occurrence, frontier, district, size)
 
-            if len(candidates) == 0:
+            # If no candidate is adjacent (very unlikely), fall back to all candidates
+            if best_cand < 0:
+                unassigned = ~assigned
+                if n_cells < 64:
+                    unassigned &= (one << np.uint64(n_cells)) - one
+                best_cand = _best_candidate_bits(co_occurrence, unassigned, district, size)
+
+            if best_cand < 0:
                 break  # nothing left to assign (shouldn't happen in 5x5 case)
 
-            # ---- contiguity filter: only candidates that touch the district ----
-            district_set = set(district)
-            contiguous_candidates = []
-            for cand in candidates:
-                nbrs = get_neighbors(cand)
-                if any(n in district_set for n in nbrs):
-                    contiguous_candidates.append(cand)
+            # Assign that cell to the district
+            assigned |= one << np.uint64(best_cand)
+            district_labels[best_cand] = current_label
+            district[size] = best_cand
+            size += 1
+            frontier = (frontier | nbr_bits[best_cand]) & ~assigned
+
+        current_label += 1
+
+    return district_labels
+
+
+@njit(cache=True)
+def _consensus_numba(co_occurrence, nbrs, cells_per_district):
+    """
+    Compiled greedy clustering core of build_consensus_map_by_modal_neighbors.
+
+    - co_occurrence: (n_cells, n_cells) uint16/uint32 co-occurrence counts
+    - nbrs: (n_cells, 4) int32 neighbor table from build_neighbor_table
+    Returns the flat int32 consensus labels.
+    """
+    n_cells = co_occurrence.shape[0]
+
+    assigned = np.zeros(n_cells, dtype=np.bool_)
+    frontier = np.zeros(n_cells, dtype=np.bool_)
+    district = np.empty(cells_per_district, dtype=np.int32)
+    district_labels = np.full(n_cells, -1, dtype=np.int32)
+    current_label = 0
+
+    for start_idx in range(n_cells):
+        if assigned[start_idx]:
+            continue
+
+        # Start a new district with this cell
+        district[0] = start_idx
+        size = 1
+        assigned[start_idx] = True
+        district_labels[start_idx] = current_label
+
+        # Frontier: unassigned cells touching the district
+        frontier[:] = False
+        for k in range(4):
+            n = nbrs[start_idx, k]
+            if n >= 0 and not assigned[n]:
+                frontier[n] = True
+
+        # Grow district until we hit the required size
+        while size < cells_per_district:
+            # Pick the frontier cell with highest co-occurrence with the district;
+            # scanning in index order keeps the lowest index on ties
+            best_cand = -1
+            best_score = -1
+            for cand in range(n_cells):
+                if frontier[cand]:
+                    score = _sum_co_occurrence(co_occurrence, cand, district, size)
+                    if score > best_score:
+                        best_score = score
+                        best_cand = cand
 
             # If no candidate is adjacent (very unlikely), fall back to all candidates
-            if len(contiguous_candidates) == 0:
-                contiguous_candidates = candidates
-
-            # Pick candidate with highest average co-occurrence with current district
-            best_cand = None
-            best_score = -1.0
-            for cand in contiguous_candidates:
-                score = co_occurrence[cand, district].mean()
-                if score > best_score:
-                    best_score = score
-                    best_cand = cand
+            if best_cand < 0:
+                for cand in range(n_cells):
+                    if not assigned[cand]:
+                        score = _sum_co_occurrence(co_occurrence, cand, district, size)
+                        if score > best_score:
+                            best_score = score
+                            best_cand = cand
+
+            if best_cand < 0:
+                break  # nothing left to assign (shouldn't happen in 5x5 case)
 
             # Assign that cell to the district
             assigned[best_cand] = True
             district_labels[best_cand] = current_label
-            district.append(best_cand)
+            district[size] = best_cand
+            size += 1
+            frontier[best_cand] = False
+            for k in range(4):
+                n = nbrs[best_cand, k]
+                if n >= 0 and not assigned[n]:
+                    frontier[n] = True
 
         current_label += 1
 
-    # ----- 3. Reshape back to HxW grid -----
-    consensus_map = district_labels.reshape(H, W)
-    return consensus_map
+    return district_labels
 
 
 
@@ -119,17 +279,38 @@ def build_consensus_map_by_modal_neighbors(plans, height=5, width=5, cells_per_d
 # 2. Visualization
 # ---------------------------------------------------------
 
-def show_consensus_map(labels, title="Consensus District Map", fig_num=None):
+# tab10 colors looked up once, and one ListedColormap per district count
+TAB10_LIST = [plt.get_cmap("tab10")(i) for i in range(10)]
+_CMAP_CACHE = {}
+
+
+def _district_cmap(num_districts):
+    """Return the (cached) colormap for a map with `num_districts` districts."""
+    if num_districts not in _CMAP_CACHE:
+        _CMAP_CACHE[num_districts] = ListedColormap(
+            [TAB10_LIST[i % 10] for i in range(num_districts)]
+        )
+    return _CMAP_CACHE[num_districts]
+
+
+def _label_stats(label_map):
+    """
+    Labels present in a map and their cell counts, from one np.unique pass.
+    Returns (labels, counts).
+    """
+    return np.unique(label_map, return_counts=True)
+
+
+def show_consensus_map(labels, title="Consensus District Map", fig_num=None, label_stats=None):
     """
     Plot each district in a different color.
+    label_stats: optional precomputed _label_stats(labels), to avoid recounting.
     """
     H, W = labels.shape
-    districts = np.unique(labels)
+    districts, sizes = label_stats if label_stats is not None else _label_stats(labels)
     num_districts = len(districts)
 
-    cmap = plt.get_cmap("tab10")
-    colors = [cmap(i % 10) for i in range(num_districts)]
-    custom_cmap = ListedColormap(colors)
+    custom_cmap = _district_cmap(num_districts)
 
     plt.figure(num=fig_num, figsize=(5, 5))
     plt.imshow(labels, cmap=custom_cmap, vmin=0, vmax=num_districts - 1)
@@ -143,8 +324,7 @@ def show_consensus_map(labels, title="Consensus District Map", fig_num=None):
     plt.tight_layout()
    
     # Print district sizes
-    unique, counts = np.unique(labels, return_counts=True)
-    print(f"  District sizes: {dict(zip(unique, counts))}")
+    print(f"  District sizes: {dict(zip(districts, sizes))}")
 
 
 
@@ -167,62 +347,49 @@ TAB10_COLOR_NAMES = {
 }
 
 
-def compute_compactness_metrics(label_map):
+def compute_compactness_metrics(label_map, per_district=True):
     """
     Compute two compactness metrics for a labeled grid:
       - cut_edges: number of edges where neighboring cells have different labels
       - polsby_popper: dict[label] -> Polsby–Popper score for that district
 
     label_map: 2D numpy array of district labels
+    per_district: set False when only the average is needed; polsby_popper
+                  is then returned as None instead of being built
     """
     label_map = np.array(label_map)
-    H, W = label_map.shape
-    labels = np.unique(label_map)
-
-    # Area and perimeter for each district
-    area = {int(l): 0 for l in labels}
-    perimeter = {int(l): 0 for l in labels}
-
-    cut_edges = 0
-
-    for r in range(H):
-        for c in range(W):
-            lab = int(label_map[r, c])
-            area[lab] += 1
-
-            # --- perimeter contributions (4-neighborhood) ---
-            # Up
-            if r == 0 or label_map[r - 1, c] != lab:
-                perimeter[lab] += 1
-            # Down
-            if r == H - 1 or label_map[r + 1, c] != lab:
-                perimeter[lab] += 1
-            # Left
-            if c == 0 or label_map[r, c - 1] != lab:
-                perimeter[lab] += 1
-            # Right
-            if c == W - 1 or label_map[r, c + 1] != lab:
-                perimeter[lab] += 1
-
-            # --- cut edges (only count each interior edge once) ---
-            if c + 1 < W and label_map[r, c] != label_map[r, c + 1]:
-                cut_edges += 1
-            if r + 1 < H and label_map[r, c] != label_map[r + 1, c]:
-                cut_edges += 1
-
-    # Polsby–Popper for each district
-    polsby_popper = {}
-    for lab in labels:
-        lab = int(lab)
-        A = area[lab]
-        P = perimeter[lab]
-        if P > 0:
-            polsby_popper[lab] = 4.0 * np.pi * A / (P ** 2)
-        else:
-            polsby_popper[lab] = 0.0
+    # Compact labels to 0..K-1 so bincount accepts arbitrary or negative labels
+    labels, codes = np.unique(label_map, return_inverse=True)
+    codes = codes.reshape(label_map.shape)
+
+    # --- cut edges (each interior edge compared once via shifted copies) ---
+    hcut = label_map[:, :-1] != label_map[:, 1:]
+    vcut = label_map[:-1, :] != label_map[1:, :]
+    cut_edges = int(hcut.sum() + vcut.sum())
+
+    # --- perimeter contributions (4-neighborhood) ---
+    # Pad with a sentinel code so grid-boundary edges count as perimeter
+    padded = np.pad(codes, 1, constant_values=-1)
+    center = padded[1:-1, 1:-1]
+    perim_per_cell = ((center != padded[:-2, 1:-1]).astype(int)   # Up
+                      + (center != padded[2:, 1:-1])              # Down
+                      + (center != padded[1:-1, :-2])             # Left
+                      + (center != padded[1:-1, 2:]))             # Right
+
+    # Area and perimeter for each district (indexed by code)
+    area = np.bincount(codes.ravel())
+    perimeter = np.bincount(codes.ravel(), weights=perim_per_cell.ravel())
+
+    # Polsby–Popper for each district present
+    pp = 4.0 * np.pi * area / np.where(perimeter > 0, perimeter ** 2, 1)
+    pp_arr = np.where(perimeter > 0, pp, 0.0)
 
     # Also return an overall average PP
-    avg_pp = float(np.mean(list(polsby_popper.values())))
+    avg_pp = float(pp_arr.mean())
+
+    polsby_popper = None
+    if per_district:
+        polsby_popper = dict(zip(labels.tolist(), pp_arr.tolist()))
 
     return cut_edges, polsby_popper, avg_pp
 
@@ -255,7 +422,7 @@ def rank_and_print_plans_by_compactness(plans, name_prefix="Plan"):
     results = []
 
     for idx, p in enumerate(plans):
-        cut_edges, pp_scores, avg_pp = compute_compactness_metrics(p)
+        cut_edges, _, avg_pp = compute_compactness_metrics(p, per_district=False)
         plan_name = f"{name_prefix} {idx + 1}"
         results.append({
             "index": idx,
@@ -301,8 +468,9 @@ if __name__ == "__main__":
     consensus_all = build_consensus_map_by_modal_neighbors(all_plans)
     print("Consensus district labels:")
     print(consensus_all)
-    print("Number of districts:", len(np.unique(consensus_all)))
-    show_consensus_map(consensus_all, title="Consensus Map - All Plans (n=20)", fig_num=1)
+    stats = _label_stats(consensus_all)
+    print("Number of districts:", len(stats[0]))
+    show_consensus_map(consensus_all, title="Consensus Map - All Plans (n=20)", fig_num=1, label_stats=stats)
     print()
    
     # Generate consensus map for neutral plans
@@ -312,8 +480,9 @@ if __name__ == "__main__":
     consensus_neutral = build_consensus_map_by_modal_neighbors(neutral_plans)
     print("Consensus district labels:")
     print(consensus_neutral)
-    print("Number of districts:", len(np.unique(consensus_neutral)))
-    show_consensus_map(consensus_neutral, title="Consensus Map - Neutral Plans (n=10)", fig_num=2)
+    stats = _label_stats(consensus_neutral)
+    print("Number of districts:", len(stats[0]))
+    show_consensus_map(consensus_neutral, title="Consensus Map - Neutral Plans (n=10)", fig_num=2, label_stats=stats)
     print()
    
     # Generate consensus map for hearts representative plans
@@ -323,8 +492,9 @@ if __name__ == "__main__":
     consensus_hearts = build_consensus_map_by_modal_neighbors(hearts_representative_plans)
     print("Consensus district labels:")
     print(consensus_hearts)
-    print("Number of districts:", len(np.unique(consensus_hearts)))
-    show_consensus_map(consensus_hearts, title="Consensus Map - Hearts Representative Plans (n=10)", fig_num=3)
+    stats = _label_stats(consensus_hearts)
+    print("Number of districts:", len(stats[0]))
+    show_consensus_map(consensus_hearts, title="Consensus Map - Hearts Representative Plans (n=10)", fig_num=3, label_stats=stats)
     print()
 
     # After computing the three consensus maps...
@@ -339,9 +509,6 @@ if __name__ == "__main__":
     # rank_and_print_plans_by_compactness(neutral_plans, name_prefix="Neutral Plan")
     # rank_and_print_plans_by_compactness(hearts_representative_plans, name_prefix="Hearts Rep Plan")
 
-    plt.show()
-
-   
     # Show all plots at once
     print("=" * 60)
     print("Displaying all 3 consensus maps...")
@@ -1,12 +1,14 @@
 """
 app.py - Flask application for redistricting
 """
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, render_template, request, jsonify, send_file, g
 import numpy as np
 import io
 import base64
 import traceback
-from database import init_db, add_user_plan, get_all_plans, delete_user_plan, get_user_plans
+import threading
+from collections import OrderedDict
+from database import GRID_SHAPE, init_db, get_db, add_user_plan, get_all_plans, get_plan_scores, delete_user_plan, get_user_plans, get_plans_version
 from redistricting_logic import (
     validate_districts, 
     calculate_district_winners,
@@ -29,6 +31,54 @@ except Exception as e:
     print(f"❌ Database initialization error: {e}")
     traceback.print_exc()
 
+def get_request_db():
+    """Return this request's database connection, opening it on first use"""
+    if 'db' not in g:
+        g.db = get_db()
+    return g.db
+
+@app.teardown_appcontext
+def close_request_db(exc):
+    """Close the request's database connection, if one was opened"""
+    db = g.pop('db', None)
+    if db is not None:
+        db.close()
+
+# Last /api/consensus payload, keyed by a fingerprint of the plan set
+_CONSENSUS_CACHE = {}
+_CONSENSUS_CACHE_LOCK = threading.Lock()
+
+# Recent /api/validate payloads keyed by the raw grid (LRU, oldest first);
+# the editor re-validates the same few layouts as users click back and forth
+_VALIDATE_CACHE = OrderedDict()
+_VALIDATE_CACHE_SIZE = 128
+_VALIDATE_CACHE_LOCK = threading.Lock()
+
+# Rendered consensus PNGs keyed by (map contents, title), LRU, oldest first
+_FIG_CACHE = OrderedDict()
+_FIG_CACHE_SIZE = 32
+_FIG_CACHE_LOCK = threading.Lock()
+
+def cached_consensus_figure(consensus_map, title):
+    """generate_consensus_figure, reusing the PNG when map and title repeat"""
+    if consensus_map is None:
+        return None
+    
+    consensus_map = np.asarray(consensus_map)
+    cache_key = (consensus_map.shape, consensus_map.astype(np.uint8).tobytes(), title)
+    with _FIG_CACHE_LOCK:
+        fig = _FIG_CACHE.get(cache_key)
+        if fig is not None:
+            _FIG_CACHE.move_to_end(cache_key)
+            return fig
+    
+    fig = generate_consensus_figure(consensus_map, title)
+    with _FIG_CACHE_LOCK:
+        _FIG_CACHE[cache_key] = fig
+        if len(_FIG_CACHE) > _FIG_CACHE_SIZE:
+            _FIG_CACHE.popitem(last=False)
+    return fig
+
 # Vote distribution (0=Club, 1=Heart)
 VOTE_GRID = [
     [0, 0, 1, 1, 1],
@@ -53,7 +103,19 @@ def index():
 def validate():
     """Validate a district plan"""
     data = request.json
-    districts = np.array(data['districts'])
+    districts = np.asarray(data['districts'])
+    
+    # Only numeric 5x5 grids are cached: oversized requests can't fill memory,
+    # and object arrays' bytes are pointers rather than contents
+    cache_key = None
+    if districts.shape == GRID_SHAPE and districts.dtype.kind in 'biuf':
+        cache_key = (districts.dtype.str, districts.shape, districts.tobytes())
+        with _VALIDATE_CACHE_LOCK:
+            payload = _VALIDATE_CACHE.get(cache_key)
+            if payload is not None:
+                _VALIDATE_CACHE.move_to_end(cache_key)
+        if payload is not None:
+            return jsonify(payload)
     
     is_valid, errors = validate_districts(districts)
     
@@ -62,17 +124,25 @@ def validate():
         hearts_won = sum(1 for w in winners.values() if w == 'Hearts')
         clubs_won = sum(1 for w in winners.values() if w == 'Clubs')
         
-        return jsonify({
+        payload = {
             'valid': True,
             'winners': winners,
             'hearts_won': hearts_won,
             'clubs_won': clubs_won
-        })
+        }
     else:
-        return jsonify({
+        payload = {
             'valid': False,
             'errors': errors
-        })
+        }
+    
+    if cache_key is not None:
+        with _VALIDATE_CACHE_LOCK:
+            _VALIDATE_CACHE[cache_key] = payload
+            if len(_VALIDATE_CACHE) > _VALIDATE_CACHE_SIZE:
+                _VALIDATE_CACHE.popitem(last=False)
+    
+    return jsonify(payload)
 
 @app.route('/api/submit', methods=['POST'])
 def submit_plan():
@@ -83,12 +153,12 @@ def submit_plan():
     user_name = data.get('name', 'Anonymous')
     
     # Validate before submission
-    is_valid, errors = validate_districts(np.array(districts))
+    is_valid, errors = validate_districts(districts)
     if not is_valid:
         return jsonify({'success': False, 'errors': errors}), 400
     
     # Add to database
-    plan_id = add_user_plan(districts, plan_type, user_name)
+    plan_id = add_user_plan(districts, plan_type, user_name, conn=get_request_db())
     
     return jsonify({
         'success': True,
@@ -99,45 +169,53 @@ def submit_plan():
 @app.route('/api/plans/user')
 def get_user_plans_route():
     """Get all user-submitted plans"""
-    plans = get_user_plans()
+    plans = get_user_plans(conn=get_request_db())
     return jsonify({'plans': plans})
 
 @app.route('/api/plans/<int:plan_id>', methods=['DELETE'])
 def delete_plan(plan_id):
     """Delete a user plan"""
-    success = delete_user_plan(plan_id)
+    success = delete_user_plan(plan_id, conn=get_request_db())
     if success:
         return jsonify({'success': True, 'message': 'Plan deleted successfully'})
     else:
         return jsonify({'success': False, 'message': 'Plan not found'}), 404
 
+def consensus_pipeline(plans, title):
+    """Build one group's consensus map; returns (figure, compactness report)"""
+    consensus = generate_consensus_maps(plans) if plans else None
+    if consensus is None:
+        return None, None
+    return cached_consensus_figure(consensus, title), get_compactness_report(consensus)
+
 @app.route('/api/consensus')
 def get_consensus():
     """Generate and return consensus maps"""
     # Get all plans (base + user)
-    all_plans_data = get_all_plans()
+    all_plans_data = get_all_plans(conn=get_request_db())
     
-    # Separate by type
-    all_plans = [np.array(p['districts']) for p in all_plans_data]
-    neutral = [np.array(p['districts']) for p in all_plans_data if p['type'] == 'neutral']
-    hearts = [np.array(p['districts']) for p in all_plans_data if p['type'] == 'hearts_representative']
+    # Reuse the last result while the plan set is unchanged
+    cache_key = (
+        len(all_plans_data),
+        max((p['id'] for p in all_plans_data), default=0),
+        get_plans_version()
+    )
+    with _CONSENSUS_CACHE_LOCK:
+        payload = _CONSENSUS_CACHE.get(cache_key)
+    if payload is not None:
+        return jsonify(payload)
     
-    # Generate consensus maps
-    consensus_all = generate_consensus_maps(all_plans)
-    consensus_neutral = generate_consensus_maps(neutral) if neutral else None
-    consensus_hearts = generate_consensus_maps(hearts) if hearts else None
+    # Separate by type; each stored grid is converted to int8 once and shared
+    all_plans = [np.asarray(p['districts'], dtype=np.int8) for p in all_plans_data]
+    neutral = [grid for grid, p in zip(all_plans, all_plans_data) if p['type'] == 'neutral']
+    hearts = [grid for grid, p in zip(all_plans, all_plans_data) if p['type'] == 'hearts_representative']
     
-    # Generate figures as base64 images
-    fig_all = generate_consensus_figure(consensus_all, f"All Plans (n={len(all_plans)})")
-    fig_neutral = generate_consensus_figure(consensus_neutral, f"Neutral Plans (n={len(neutral)})") if consensus_neutral is not None else None
-    fig_hearts = generate_consensus_figure(consensus_hearts, f"Hearts Plans (n={len(hearts)})") if consensus_hearts is not None else None
+    # Generate consensus maps, base64 figures and compactness metrics per group
+    fig_all, compactness_all = consensus_pipeline(all_plans, f"All Plans (n={len(all_plans)})")
+    fig_neutral, compactness_neutral = consensus_pipeline(neutral, f"Neutral Plans (n={len(neutral)})")
+    fig_hearts, compactness_hearts = consensus_pipeline(hearts, f"Hearts Plans (n={len(hearts)})")
     
-    # Get compactness metrics for consensus maps
-    compactness_all = get_compactness_report(consensus_all) if consensus_all is not None else None
-    compactness_neutral = get_compactness_report(consensus_neutral) if consensus_neutral is not None else None
-    compactness_hearts = get_compactness_report(consensus_hearts) if consensus_hearts is not None else None
-    
-    return jsonify({
+    payload = {
         'all_plans': fig_all,
         'neutral_plans': fig_neutral,
         'hearts_plans': fig_hearts,
@@ -151,13 +229,18 @@ def get_consensus():
             'neutral': compactness_neutral,
             'hearts': compactness_hearts
         }
-    })
+    }
+    with _CONSENSUS_CACHE_LOCK:
+        _CONSENSUS_CACHE.clear()
+        _CONSENSUS_CACHE[cache_key] = payload
+    
+    return jsonify(payload)
 
 @app.route('/api/rankings')
 def get_rankings():
     """Get all plans ranked by compactness"""
-    all_plans_data = get_all_plans()
-    rankings = rank_plans_by_compactness(all_plans_data)
+    plan_scores = get_plan_scores(conn=get_request_db())
+    rankings = rank_plans_by_compactness(plan_scores)
     
     return jsonify({
         'rankings': rankings
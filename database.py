@@ -1,5 +1,6 @@
 import sqlite3
 import json
+from contextlib import contextmanager
 import numpy as np
 from datetime import datetime
 import pytz 
@@ -7,142 +8,264 @@ from Plans import neutral_plans, hearts_representative_plans
 
 DB_PATH = 'instance/redistricting.db'
 ST_LOUIS_TZ = pytz.timezone('America/Chicago')
+GRID_SHAPE = (5, 5)
+
+# Bumped on every write to the plans table so callers can cache derived results
+_plans_version = 0
+
+def get_plans_version():
+    """Return a counter that changes whenever plans are added or deleted"""
+    return _plans_version
+
+def _bump_plans_version():
+    global _plans_version
+    _plans_version += 1
 
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
+    """Open a connection; callers that need one per request should reuse it"""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    # WAL (set persistently by init_db) only needs NORMAL sync to stay safe
+    conn.execute('PRAGMA synchronous=NORMAL')
     return conn
 
-def init_db():
+@contextmanager
+def _connection(conn=None):
+    """Use the caller's connection if given, else open one and close it after"""
+    if conn is not None:
+        yield conn
+        return
+    conn = get_db()
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def pack_districts(districts):
+    """Pack a 5x5 district grid (labels 0-4) into a 25-byte uint8 BLOB"""
+    return np.asarray(districts, dtype=np.uint8).tobytes()
+
+def unpack_districts(row):
+    """Read a row's district grid, preferring the packed BLOB over the JSON text"""
+    if row['districts_bin'] is not None:
+        return np.frombuffer(row['districts_bin'], dtype=np.uint8).reshape(GRID_SHAPE).tolist()
+    return json.loads(row['districts'])
+
+def plan_metrics(districts):
+    """Compactness scores stored alongside each plan: (cut_edges, avg_pp)"""
+    # Imported here so the DB layer doesn't load matplotlib, PIL fonts and
+    # the Numba kernels until a plan actually needs scoring
+    from redistricting_logic import compute_compactness_metrics
+    cut_edges, _, avg_pp = compute_compactness_metrics(districts, per_district=False)
+    return int(cut_edges), float(avg_pp)
+
+def _backfill_metrics(cursor):
+    """Store compactness for rows that lack it; returns {id: (cut_edges, avg_pp)}"""
+    cursor.execute('SELECT id, districts, districts_bin FROM plans WHERE cut_edges IS NULL OR avg_pp IS NULL')
+    metrics = {row['id']: plan_metrics(unpack_districts(row)) for row in cursor.fetchall()}
+    cursor.executemany(
+        'UPDATE plans SET cut_edges = ?, avg_pp = ? WHERE id = ?',
+        [(*scores, plan_id) for plan_id, scores in metrics.items()]
+    )
+    return metrics
+
+def _ensure_column(cursor, name, decl):
+    """Add a column to the plans table if an older database lacks it"""
+    cursor.execute('PRAGMA table_info(plans)')
+    if name not in [col['name'] for col in cursor.fetchall()]:
+        cursor.execute(f'ALTER TABLE plans ADD COLUMN {name} {decl}')
+
+def init_db(conn=None):
     import os
     os.makedirs('instance', exist_ok=True)
     
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    # Create tables
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS plans (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            districts TEXT NOT NULL,
-            type TEXT NOT NULL,
-            user_name TEXT,
-            is_base INTEGER DEFAULT 0,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Check if base plans already exist
-    cursor.execute('SELECT COUNT(*) FROM plans WHERE is_base = 1')
-    base_count = cursor.fetchone()[0]
-    
-    if base_count == 0:
-        # Insert base neutral plans (plans 1-10)
-        for i, plan in enumerate(neutral_plans):
-            districts_json = json.dumps(plan.tolist())
-            cursor.execute(
-                'INSERT INTO plans (districts, type, user_name, is_base) VALUES (?, ?, ?, ?)',
-                (districts_json, 'neutral', f'Base Plan {i+1}', 1)
+    with _connection(conn) as conn:
+        # WAL lets readers proceed while a plan is being written; the mode
+        # is stored in the database file, so it only needs setting once
+        conn.execute('PRAGMA journal_mode=WAL')
+        cursor = conn.cursor()
+    
+        # Create tables
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS plans (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                districts TEXT NOT NULL,
+                type TEXT NOT NULL,
+                user_name TEXT,
+                is_base INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                districts_bin BLOB,
+                cut_edges INTEGER,
+                avg_pp REAL
             )
+        ''')
+    
+        # Migrate older databases: add the packed column and backfill it from JSON
+        # (the JSON column is still written for back-compat)
+        _ensure_column(cursor, 'districts_bin', 'BLOB')
+        cursor.execute('SELECT id, districts FROM plans WHERE districts_bin IS NULL')
+        cursor.executemany(
+            'UPDATE plans SET districts_bin = ? WHERE id = ?',
+            [(pack_districts(json.loads(row['districts'])), row['id']) for row in cursor.fetchall()]
+        )
+    
+        # Plans never change after insert, so compactness is computed once and
+        # stored; backfill rows written before these columns existed
+        _ensure_column(cursor, 'cut_edges', 'INTEGER')
+        _ensure_column(cursor, 'avg_pp', 'REAL')
+        _backfill_metrics(cursor)
+    
+        # Every listing query filters/orders by (is_base, id); index it so
+        # SQLite walks the index instead of sorting the table each call
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_plans_base_id ON plans(is_base DESC, id ASC)')
+    
+        # Check if base plans already exist
+        cursor.execute('SELECT COUNT(*) FROM plans WHERE is_base = 1')
+        base_count = cursor.fetchone()[0]
+    
+        if base_count == 0:
+            # Base neutral plans (plans 1-10)
+            rows = [
+                (json.dumps(plan.tolist()), pack_districts(plan), *plan_metrics(plan), 'neutral', f'Base Plan {i+1}', 1)
+                for i, plan in enumerate(neutral_plans)
+            ]
+            # Base hearts representative plans (plans 11-20)
+            rows += [
+                (json.dumps(plan.tolist()), pack_districts(plan), *plan_metrics(plan), 'hearts_representative', f'Base Plan {i+11}', 1)
+                for i, plan in enumerate(hearts_representative_plans)
+            ]
         
-        # Insert base hearts representative plans (plans 11-20)
-        for i, plan in enumerate(hearts_representative_plans):
-            districts_json = json.dumps(plan.tolist())
-            cursor.execute(
-                'INSERT INTO plans (districts, type, user_name, is_base) VALUES (?, ?, ?, ?)',
-                (districts_json, 'hearts_representative', f'Base Plan {i+11}', 1)
+            # One prepared statement for all rows; sqlite3 keeps them in a single
+            # implicit transaction that the commit below closes
+            cursor.executemany(
+                'INSERT INTO plans (districts, districts_bin, cut_edges, avg_pp, type, user_name, is_base) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                rows
             )
         
-        print(f"Initialized database with {len(neutral_plans) + len(hearts_representative_plans)} base plans")
+            print(f"Initialized database with {len(neutral_plans) + len(hearts_representative_plans)} base plans")
     
-    conn.commit()
-    conn.close()
+        conn.commit()
 
-def add_user_plan(districts, plan_type, user_name='Anonymous'):
+def add_user_plan(districts, plan_type, user_name='Anonymous', conn=None):
     """Add a user-submitted plan with St. Louis CST timezone"""
-    conn = get_db()
-    cursor = conn.cursor()
-    st_louis_time = datetime.now(ST_LOUIS_TZ).strftime('%Y-%m-%d %H:%M:%S')
+    with _connection(conn) as conn:
+        cursor = conn.cursor()
+        st_louis_time = datetime.now(ST_LOUIS_TZ).strftime('%Y-%m-%d %H:%M:%S')
     
-    districts_json = json.dumps(districts)
-    cursor.execute(
-        'INSERT INTO plans (districts, type, user_name, is_base, created_at) VALUES (?, ?, ?, ?, ?)',
-        (districts_json, plan_type, user_name, 0, st_louis_time)
-    )
+        districts_json = json.dumps(districts)
+        cursor.execute(
+            'INSERT INTO plans (districts, districts_bin, cut_edges, avg_pp, type, user_name, is_base, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (districts_json, pack_districts(districts), *plan_metrics(districts), plan_type, user_name, 0, st_louis_time)
+        )
     
-    plan_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+        plan_id = cursor.lastrowid
+        conn.commit()
+        _bump_plans_version()
     
-    return plan_id
+        return plan_id
 
-def get_all_plans():
+def get_all_plans(conn=None):
     """Get all plans (base + user)"""
-    conn = get_db()
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT * FROM plans ORDER BY is_base DESC, id ASC')
-    rows = cursor.fetchall()
-    conn.close()
-    
-    plans = []
-    for row in rows:
-        plans.append({
-            'id': row['id'],
-            'districts': json.loads(row['districts']),
-            'type': row['type'],
-            'user_name': row['user_name'],
-            'is_base': bool(row['is_base']),
-            'created_at': row['created_at']
-        })
-    
-    return plans
-
-def get_user_plans():
+    with _connection(conn) as conn:
+        cursor = conn.cursor()
+    
+        cursor.execute(
+            'SELECT id, districts, districts_bin, type, user_name, is_base, created_at '
+            'FROM plans ORDER BY is_base DESC, id ASC'
+        )
+        rows = cursor.fetchall()
+    
+        plans = []
+        for row in rows:
+            plans.append({
+                'id': row['id'],
+                'districts': unpack_districts(row),
+                'type': row['type'],
+                'user_name': row['user_name'],
+                'is_base': bool(row['is_base']),
+                'created_at': row['created_at']
+            })
+    
+        return plans
+
+def get_plan_scores(conn=None):
+    """
+    Get every plan's stored compactness scores, without the district grids
+    Rows still missing scores (e.g. written by an older app instance after
+    init_db ran) are scored from their grids and backfilled first
+    """
+    with _connection(conn) as conn:
+        cursor = conn.cursor()
+    
+        cursor.execute(
+            'SELECT id, type, user_name, is_base, cut_edges, avg_pp FROM plans ORDER BY is_base DESC, id ASC'
+        )
+        rows = cursor.fetchall()
+    
+        backfilled = {}
+        if any(row['cut_edges'] is None or row['avg_pp'] is None for row in rows):
+            backfilled = _backfill_metrics(cursor)
+            conn.commit()
+    
+        plans = []
+        for row in rows:
+            cut_edges, avg_pp = backfilled.get(row['id'], (row['cut_edges'], row['avg_pp']))
+            plans.append({
+                'id': row['id'],
+                'type': row['type'],
+                'user_name': row['user_name'],
+                'is_base': bool(row['is_base']),
+                'cut_edges': cut_edges,
+                'avg_pp': avg_pp
+            })
+    
+        return plans
+
+def get_user_plans(conn=None):
     """Get only user-submitted plans (not base plans) with CST display"""
-    conn = get_db()
-    cursor = conn.cursor()
+    with _connection(conn) as conn:
+        cursor = conn.cursor()
     
-    cursor.execute('SELECT * FROM plans WHERE is_base = 0 ORDER BY id DESC')
-    rows = cursor.fetchall()
-    conn.close()
+        cursor.execute(
+            'SELECT id, districts, districts_bin, type, user_name, created_at '
+            'FROM plans WHERE is_base = 0 ORDER BY id DESC'
+        )
+        rows = cursor.fetchall()
     
-    plans = []
-    for row in rows:
-        created_at = row['created_at']
+        plans = []
+        for row in rows:
+            created_at = row['created_at']
         
-        plans.append({
-            'id': row['id'],
-            'districts': json.loads(row['districts']),
-            'type': row['type'],
-            'user_name': row['user_name'],
-            'created_at': created_at
-        })
+            plans.append({
+                'id': row['id'],
+                'districts': unpack_districts(row),
+                'type': row['type'],
+                'user_name': row['user_name'],
+                'created_at': created_at
+            })
     
-    return plans
+        return plans
 
-def delete_user_plan(plan_id):
+def delete_user_plan(plan_id, conn=None):
     """Delete a user plan (cannot delete base plans)"""
-    conn = get_db()
-    cursor = conn.cursor()
+    with _connection(conn) as conn:
+        cursor = conn.cursor()
     
-    # Check if it's a user plan
-    cursor.execute('SELECT is_base FROM plans WHERE id = ?', (plan_id,))
-    row = cursor.fetchone()
+        # Check if it's a user plan
+        cursor.execute('SELECT is_base FROM plans WHERE id = ?', (plan_id,))
+        row = cursor.fetchone()
     
-    if row is None:
-        conn.close()
-        return False
+        if row is None:
+            return False
     
-    if row['is_base'] == 1:
-        conn.close()
-        return False  # Cannot delete base plans
+        if row['is_base'] == 1:
+            return False  # Cannot delete base plans
     
-    cursor.execute('DELETE FROM plans WHERE id = ?', (plan_id,))
-    conn.commit()
-    conn.close()
+        cursor.execute('DELETE FROM plans WHERE id = ?', (plan_id,))
+        conn.commit()
+        _bump_plans_version()
     
-    return True
+        return True
 
 if __name__ == '__main__':
     init_db()
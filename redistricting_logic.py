@@ -7,8 +7,15 @@ import matplotlib
 matplotlib.use('Agg') 
 import matplotlib.pyplot as plt
 from matplotlib.colors import ListedColormap
+from matplotlib.figure import Figure
+from matplotlib import font_manager
+from PIL import Image, ImageDraw, ImageFont
 import io
 import base64
+import threading
+from functools import lru_cache
+from collections import Counter
+from numba import njit
 
 # Color names matching matplotlib's tab10 colormap indices
 TAB10_COLOR_NAMES = {
@@ -24,241 +31,510 @@ TAB10_COLOR_NAMES = {
     9: "Cyan"
 }
 
+GRID_H, GRID_W = 5, 5
+
+def _compute_nbrs(idx):
+    """4-neighbors (N, S, W, E) of a flat cell index on the 5x5 grid"""
+    r, c = divmod(idx, GRID_W)
+    nbrs = []
+    if r > 0: nbrs.append(idx - GRID_W)
+    if r < GRID_H - 1: nbrs.append(idx + GRID_W)
+    if c > 0: nbrs.append(idx - 1)
+    if c < GRID_W - 1: nbrs.append(idx + 1)
+    return nbrs
+
+# 25-bit neighbor mask per cell for the compiled greedy clustering, built
+# once at import from the neighbor lists
+NEIGHBORS = tuple(tuple(_compute_nbrs(i)) for i in range(GRID_H * GRID_W))
+ADJ_MASK = tuple(sum(1 << n for n in nbrs) for nbrs in NEIGHBORS)
+ADJ_BITS = np.array(ADJ_MASK, dtype=np.uint64)
+
+# Error bits returned by _validate_nb: bit d means district d has the wrong
+# cell count, bit 5 + d that it is not contiguous; ERR_OTHER_LABEL flags
+# cells whose label is outside 0-4
+ERR_COUNT_SHIFT = 0
+ERR_CONTIG_SHIFT = 5
+ERR_OTHER_LABEL = 1 << 10
+
 def validate_districts(districts):
     """
     Validate a district plan
     Returns: (is_valid, errors_list)
+    Results are cached by the grid's contents (see _validate_cached)
     """
-    districts = np.array(districts)
+    districts = np.asarray(districts)
+    if districts.shape != (GRID_H, GRID_W):
+        # Not a 5x5 grid (e.g. [], a flat list or a 1x25 row)
+        return False, ["Plan must be a 5x5 grid."]
+    
+    if districts.dtype.kind not in 'biuf':
+        # Strings/objects: usable only if every cell equals a label 0-4
+        counts = np.array([np.sum(districts == d) for d in range(5)])
+        if counts.sum() != districts.size:
+            return _validation_errors(districts, _count_errors(counts) | ERR_OTHER_LABEL, counts)
+        districts = districts.astype(np.int64)
+    
+    is_valid, errors = _validate_cached(districts.dtype.str, districts.shape, districts.tobytes())
+    return is_valid, list(errors)
+
+@lru_cache(maxsize=4096)
+def _validate_cached(dtype_str, shape, raw):
+    """validate_districts for a grid given as (dtype, shape, bytes); errors as a tuple"""
+    districts = np.frombuffer(raw, dtype=dtype_str).reshape(shape)
+    is_valid, errors = _validate_grid(districts)
+    return is_valid, tuple(errors)
+
+def _validate_grid(districts):
+    """validate_districts on a numeric ndarray, without the cache"""
+    error_mask, counts = _validate_nb(np.ascontiguousarray(districts))
+    if error_mask == 0:
+        return True, []
+    return _validation_errors(districts, error_mask, counts)
+
+def _count_errors(counts):
+    """Error bits for districts 0-4 whose cell count is not 5"""
+    return sum(1 << (ERR_COUNT_SHIFT + d) for d in range(5) if counts[d] != 5)
+
+def _validation_errors(districts, error_mask, counts):
+    """Turn _validate_nb's error bits into validate_districts' result"""
     errors = []
     
     # Check 1: Must have exactly 5 districts (0-4)
-    unique_districts = np.unique(districts)
-    if len(unique_districts) != 5:
-        errors.append(f"Must have exactly 5 districts. Found {len(unique_districts)}.")
+    if error_mask & ERR_OTHER_LABEL:
+        n_found = len(np.unique(districts))
+    else:
+        n_found = int(np.count_nonzero(counts))
+    if n_found != 5:
+        errors.append(f"Must have exactly 5 districts. Found {n_found}.")
         return False, errors
     
     # Check 2: Each district must have exactly 5 cells
     for d in range(5):
-        count = np.sum(districts == d)
-        if count != 5:
-            errors.append(f"District {d +1} has {count} cells. Each district must have exactly 5 cells.")
+        if error_mask >> (ERR_COUNT_SHIFT + d) & 1:
+            errors.append(f"District {d +1} has {counts[d]} cells. Each district must have exactly 5 cells.")
     
     if errors:
         return False, errors
     
     # Check 3: Each district must be contiguous (4-connected)
     for d in range(5):
-        if not is_contiguous(districts, d):
+        if error_mask >> (ERR_CONTIG_SHIFT + d) & 1:
             errors.append(f"District {d +1} is not contiguous. All cells must connect by sides (not corners).")
     
-    if errors:
-        return False, errors
+    return False, errors
+
+@njit(cache=True)
+def _uf_find(parent, i):
+    """Union-find root of i, halving the path on the way up"""
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+@njit(cache=True)
+def _validate_nb(districts):
+    """
+    All of validate_districts' checks in one compiled kernel
+    districts: 2D array of labels
+    Returns (error_mask, counts): error bits as described at
+    ERR_COUNT_SHIFT, and the cell count of each label 0-4. A plan with
+    a wrong count fails on the counting pass, before any union-find work.
+    """
+    H, W = districts.shape
+    n_cells = H * W
+    counts = np.zeros(5, dtype=np.int64)
+    error_mask = 0
     
-    return True, []
+    # Pass 1: bincount the labels; anything outside 0-4 is flagged
+    for r in range(H):
+        for c in range(W):
+            lab = districts[r, c]
+            if 0 <= lab <= 4 and lab == int(lab):
+                counts[int(lab)] += 1
+            else:
+                error_mask |= ERR_OTHER_LABEL
+    
+    for d in range(5):
+        if counts[d] != 5:
+            error_mask |= 1 << (ERR_COUNT_SHIFT + d)
+    if error_mask:
+        return error_mask, counts
+    
+    # Pass 2: union each cell with its same-label E and S neighbors
+    parent = np.arange(n_cells)
+    for idx in range(n_cells):
+        r = idx // W
+        c = idx % W
+        lab = districts[r, c]
+        if c < W - 1 and districts[r, c + 1] == lab:
+            parent[_uf_find(parent, idx + 1)] = _uf_find(parent, idx)
+        if r < H - 1 and districts[r + 1, c] == lab:
+            parent[_uf_find(parent, idx + W)] = _uf_find(parent, idx)
+    
+    # A district is contiguous when all its cells share one root
+    roots = np.full(5, -1, dtype=np.int64)
+    for idx in range(n_cells):
+        d = int(districts[idx // W, idx % W])
+        root = _uf_find(parent, idx)
+        if roots[d] < 0:
+            roots[d] = root
+        elif roots[d] != root:
+            error_mask |= 1 << (ERR_CONTIG_SHIFT + d)
+    
+    return error_mask, counts
 
 def is_contiguous(districts, district_num):
-    """Check if a district is contiguous using flood fill"""
+    """
+    Check if a district is contiguous using flood fill
+    districts: 2D integer array, passed to the kernel without conversion
+    (only copied if it is not C-contiguous)
+    """
+    return _is_contiguous_nb(np.ascontiguousarray(districts), district_num)
+
+@njit(cache=True)
+def _is_contiguous_nb(districts, district_num):
+    """
+    Compiled flood fill behind is_contiguous
+    districts: 2D integer array; cells are flat indices r * W + c, the
+    stack is a fixed int32 array and visited a bool array
+    """
     H, W = districts.shape
-    district_cells = np.argwhere(districts == district_num)
-    
-    if len(district_cells) == 0:
+    n_cells = H * W
+    
+    # Count the district's cells and find the first one (row-major)
+    size = 0
+    start = -1
+    for idx in range(n_cells):
+        if districts[idx // W, idx % W] == district_num:
+            size += 1
+            if start < 0:
+                start = idx
+    
+    if size == 0:
         return False
     
-    # Start from first cell and flood fill
-    visited = set()
-    stack = [tuple(district_cells[0])]
-    
-    while stack:
-        r, c = stack.pop()
-        if (r, c) in visited:
-            continue
-        visited.add((r, c))
+    # Start from first cell and flood fill; cells are marked when pushed,
+    # so the stack never holds more than n_cells entries
+    visited = np.zeros(n_cells, dtype=np.bool_)
+    stack = np.empty(n_cells, dtype=np.int32)
+    stack[0] = start
+    sp = 1
+    visited[start] = True
+    reached = 0
+    
+    while sp > 0:
+        sp -= 1
+        idx = stack[sp]
+        reached += 1
+        r = idx // W
+        c = idx % W
         
-        # Check 4 neighbors (N, S, E, W)
-        for dr, dc in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
-            nr, nc = r + dr, c + dc
-            if 0 <= nr < H and 0 <= nc < W:
-                if districts[nr, nc] == district_num and (nr, nc) not in visited:
-                    stack.append((nr, nc))
-    
-    return len(visited) == len(district_cells)
+        # Check 4 neighbors (N, S, W, E)
+        if r > 0 and not visited[idx - W] and districts[r - 1, c] == district_num:
+            visited[idx - W] = True
+            stack[sp] = idx - W
+            sp += 1
+        if r < H - 1 and not visited[idx + W] and districts[r + 1, c] == district_num:
+            visited[idx + W] = True
+            stack[sp] = idx + W
+            sp += 1
+        if c > 0 and not visited[idx - 1] and districts[r, c - 1] == district_num:
+            visited[idx - 1] = True
+            stack[sp] = idx - 1
+            sp += 1
+        if c < W - 1 and not visited[idx + 1] and districts[r, c + 1] == district_num:
+            visited[idx + 1] = True
+            stack[sp] = idx + 1
+            sp += 1
+    
+    return reached == size
 
 def calculate_district_winners(districts, vote_grid):
     """
     Calculate which party wins each district
     Returns: dict {district_num: 'Hearts' or 'Clubs'}
     """
-    districts = np.array(districts)
-    vote_grid = np.array(vote_grid)
-    winners = {}
+    districts = np.ascontiguousarray(districts, dtype=np.int8).ravel()
+    vote_grid = np.ascontiguousarray(vote_grid, dtype=np.int8).ravel()
     
-    for d in range(5):
-        district_mask = districts == d
-        hearts = np.sum(vote_grid[district_mask] == 1)
-        clubs = np.sum(vote_grid[district_mask] == 0)
-        winners[d] = 'Hearts' if hearts > clubs else 'Clubs'
+    # Tally each party per district in one pass each
+    hearts = np.bincount(districts, weights=(vote_grid == 1), minlength=5)
+    clubs = np.bincount(districts, weights=(vote_grid == 0), minlength=5)
     
-    return winners
+    return {d: 'Hearts' if hearts[d] > clubs[d] else 'Clubs' for d in range(5)}
 
 def generate_consensus_maps(plans):
     """Generate consensus map from multiple plans (simplified version)"""
     if not plans:
         return None
     
-    plans = [np.array(p) for p in plans]
-    H, W = 5, 5
+    H, W = GRID_H, GRID_W
     n_plans = len(plans)
     
-    # Build co-occurrence matrix
-    co_occurrence = np.zeros((25, 25), dtype=float)
-    
-    for p in plans:
-        flat = p.flatten()
-        for i in range(25):
-            for j in range(25):
-                if flat[i] == flat[j]:
-                    co_occurrence[i, j] += 1.0
+    # Identical plans contribute identical equality matrices, so group them
+    # by their int8 bytes and weight each distinct plan by its multiplicity
+    multiplicity = Counter(np.ascontiguousarray(p, dtype=np.int8).tobytes() for p in plans)
+    flat_all = np.frombuffer(b''.join(multiplicity), dtype=np.int8).reshape(-1, H * W)
+    count_dtype = np.uint16 if n_plans <= np.iinfo(np.uint16).max else np.uint32
+    weights = np.fromiter(multiplicity.values(), dtype=count_dtype, count=len(multiplicity))
     
-    co_occurrence /= n_plans
+    # Build co-occurrence matrix: one (n_unique, 25, 25) equality broadcast
+    # over int8 labels, kept as raw counts. Every candidate in a step is
+    # averaged over the same district size, so comparing sums picks the
+    # same cell as comparing means and no division is needed.
+    same = flat_all[:, :, None] == flat_all[:, None, :]
+    co_occurrence = (same * weights[:, None, None]).sum(axis=0, dtype=count_dtype)
     
-    # Greedy clustering with contiguity
-    def rc_to_idx(r, c):
-        return r * W + c
+    # Greedy clustering with contiguity, compiled (see _greedy_consensus)
+    district_labels = _greedy_consensus(co_occurrence, ADJ_BITS)
     
-    def idx_to_rc(idx):
-        return divmod(idx, W)
-    
-    def get_neighbors(idx):
-        r, c = idx_to_rc(idx)
-        nbrs = []
-        if r > 0: nbrs.append(rc_to_idx(r-1, c))
-        if r < H-1: nbrs.append(rc_to_idx(r+1, c))
-        if c > 0: nbrs.append(rc_to_idx(r, c-1))
-        if c < W-1: nbrs.append(rc_to_idx(r, c+1))
-        return nbrs
+    return district_labels.reshape(H, W)
+
+@njit(cache=True)
+def _greedy_consensus(co_occurrence, adj_bits):
+    """
+    Compiled greedy clustering behind generate_consensus_maps
+    co_occurrence: (25, 25) integer co-occurrence counts
+    adj_bits: uint64 neighbor mask per cell (ADJ_BITS)
+    Cell sets are bitmasks (bit i set = cell i); returns flat int32 labels
+    """
+    n_cells = co_occurrence.shape[0]
+    one = np.uint64(1)
+    full = (one << np.uint64(n_cells)) - one
     
-    assigned = np.zeros(25, dtype=bool)
-    district_labels = np.full(25, -1, dtype=int)
+    assigned = np.uint64(0)
+    district_labels = np.full(n_cells, -1, dtype=np.int32)
+    score = np.empty(n_cells, dtype=np.int64)
     current_label = 0
     
-    for start_idx in range(25):
-        if assigned[start_idx]:
+    for start_idx in range(n_cells):
+        start_bit = one << np.uint64(start_idx)
+        if assigned & start_bit:
             continue
         
-        district = [start_idx]
-        assigned[start_idx] = True
+        assigned |= start_bit
         district_labels[start_idx] = current_label
+        reach = adj_bits[start_idx]  # cells adjacent to any district cell
+        # score[c] = sum of co_occurrence[c, d] over district cells d
+        for c in range(n_cells):
+            score[c] = co_occurrence[c, start_idx]
+        size = 1
         
-        while len(district) < 5:
-            candidates = np.where(~assigned)[0]
-            if len(candidates) == 0:
+        while size < 5:
+            unassigned = full & ~assigned
+            if not unassigned:
                 break
             
-            district_set = set(district)
-            contiguous = [c for c in candidates if any(n in district_set for n in get_neighbors(c))]
+            # Adjacent candidates, else fall back to all unassigned cells
+            candidates = reach & unassigned
+            if not candidates:
+                candidates = unassigned
             
-            if not contiguous:
-                contiguous = candidates
+            # Highest co-occurrence sum; bits are walked lowest first and only
+            # a strictly higher score replaces the best, so ties keep the first
+            best_cand = -1
+            best_score = np.int64(-1)
+            cand = 0
+            while candidates:
+                if candidates & one and score[cand] > best_score:
+                    best_score = score[cand]
+                    best_cand = cand
+                candidates >>= one
+                cand += 1
             
-            best_cand = max(contiguous, key=lambda c: co_occurrence[c, district].mean())
-            
-            assigned[best_cand] = True
+            assigned |= one << np.uint64(best_cand)
             district_labels[best_cand] = current_label
-            district.append(best_cand)
+            reach |= adj_bits[best_cand]
+            for c in range(n_cells):
+                score[c] += co_occurrence[c, best_cand]
+            size += 1
         
         current_label += 1
     
-    return district_labels.reshape(H, W)
+    return district_labels
+
+# Consensus images are drawn straight into a pixel array and PNG-encoded with
+# PIL; set this to True to render them through matplotlib instead
+USE_MATPLOTLIB_FIGURES = False
+
+CELL_PX = 100        # side of one grid cell in the PIL image
+GRID_LINE_PX = 3     # black grid line width (matplotlib's linewidth=2 at 100 dpi)
+TITLE_PX = 22        # title font size (16 pt at 100 dpi)
+TITLE_PAD_PX = 12    # space above and below the title
+
+# tab10 colors for labels 0-4 as uint8 RGB, looked up per cell
+PALETTE = (np.array([plt.get_cmap("tab10")(i % 10)[:3] for i in range(5)]) * 255).round().astype(np.uint8)
+
+# Same bold sans-serif matplotlib would use for the title
+_TITLE_FONT = ImageFont.truetype(
+    font_manager.findfont(font_manager.FontProperties(weight='bold')), TITLE_PX
+)
+
+def _consensus_png(consensus_map, title):
+    """PNG bytes for a consensus map: colored cells, grid lines and a title"""
+    consensus_map = np.asarray(consensus_map)
+    H, W = consensus_map.shape
+    
+    # Colormap lookup, then upsample each cell to CELL_PX x CELL_PX
+    rgb = PALETTE[np.clip(consensus_map, 0, len(PALETTE) - 1)]
+    rgb = np.repeat(np.repeat(rgb, CELL_PX, axis=0), CELL_PX, axis=1)
+    
+    # Grid lines on every cell boundary, including the outer border
+    half = GRID_LINE_PX // 2
+    for k in range(H + 1):
+        y = min(max(k * CELL_PX - half, 0), H * CELL_PX - GRID_LINE_PX)
+        rgb[y:y + GRID_LINE_PX, :] = 0
+    for k in range(W + 1):
+        x = min(max(k * CELL_PX - half, 0), W * CELL_PX - GRID_LINE_PX)
+        rgb[:, x:x + GRID_LINE_PX] = 0
+    
+    # Title strip above the grid, text centered
+    left, top, right, bottom = _TITLE_FONT.getbbox(title)
+    strip = bottom + 2 * TITLE_PAD_PX
+    image = Image.new('RGB', (W * CELL_PX, H * CELL_PX + strip), 'white')
+    image.paste(Image.fromarray(rgb), (0, strip))
+    draw = ImageDraw.Draw(image)
+    draw.text(((W * CELL_PX - (right - left)) / 2 - left, TITLE_PAD_PX), title,
+              fill='black', font=_TITLE_FONT)
+    
+    buf = io.BytesIO()
+    image.save(buf, format='PNG', optimize=False)
+    return buf.getvalue()
+
+# One Figure reused for every matplotlib consensus image: built on first use,
+# then only the image data and title change per call. The lock serializes renders.
+_CONSENSUS_FIG = None
+_CONSENSUS_AX = None
+_CONSENSUS_IMG = None
+_CONSENSUS_FIG_LOCK = threading.Lock()
+
+# Subplot params of a fresh Figure; restored before each tight_layout so the
+# layout does not depend on the previous render's title
+_SUBPLOT_DEFAULTS = {k: matplotlib.rcParams[f'figure.subplot.{k}']
+                     for k in ('left', 'right', 'bottom', 'top', 'wspace', 'hspace')}
+
+def _consensus_figure_parts():
+    """Return the shared (fig, ax, image), creating them on first call"""
+    global _CONSENSUS_FIG, _CONSENSUS_AX, _CONSENSUS_IMG
+    if _CONSENSUS_FIG is None:
+        cmap = plt.get_cmap("tab10")
+        colors = [cmap(i % 10) for i in range(5)]
+        custom_cmap = ListedColormap(colors)
+        
+        fig = Figure(figsize=(6, 6))
+        ax = fig.subplots()
+        img = ax.imshow(np.zeros((GRID_H, GRID_W), dtype=int), cmap=custom_cmap, vmin=0, vmax=4)
+        
+        # Grid lines
+        ax.set_xticks(np.arange(-0.5, 5, 1))
+        ax.set_yticks(np.arange(-0.5, 5, 1))
+        ax.set_xticklabels([])
+        ax.set_yticklabels([])
+        ax.grid(color="black", linewidth=2)
+        
+        _CONSENSUS_FIG, _CONSENSUS_AX, _CONSENSUS_IMG = fig, ax, img
+    return _CONSENSUS_FIG, _CONSENSUS_AX, _CONSENSUS_IMG
+
+def _matplotlib_png(consensus_map, title):
+    """PNG bytes for a consensus map rendered through the shared Figure"""
+    with _CONSENSUS_FIG_LOCK:
+        fig, ax, img = _consensus_figure_parts()
+        img.set_data(consensus_map)
+        ax.set_title(title, fontsize=16, fontweight='bold')
+        
+        fig.subplots_adjust(**_SUBPLOT_DEFAULTS)
+        fig.tight_layout()
+        
+        buf = io.BytesIO()
+        fig.savefig(buf, format='png', dpi=100, bbox_inches='tight')
+    return buf.getvalue()
 
 def generate_consensus_figure(consensus_map, title):
-    """Generate matplotlib figure as base64 image"""
+    """
+    Generate consensus map image as base64 PNG
+    Drawn directly with PIL unless USE_MATPLOTLIB_FIGURES is set; the
+    matplotlib path locks its shared Figure because the threaded Flask
+    server can render for two requests at once
+    """
     if consensus_map is None:
         return None
     
-    cmap = plt.get_cmap("tab10")
-    colors = [cmap(i % 10) for i in range(5)]
-    custom_cmap = ListedColormap(colors)
-    
-    fig, ax = plt.subplots(figsize=(6, 6))
-    ax.imshow(consensus_map, cmap=custom_cmap, vmin=0, vmax=4)
-    
-    # Grid lines
-    ax.set_xticks(np.arange(-0.5, 5, 1))
-    ax.set_yticks(np.arange(-0.5, 5, 1))
-    ax.set_xticklabels([])
-    ax.set_yticklabels([])
-    ax.grid(color="black", linewidth=2)
-    ax.set_title(title, fontsize=16, fontweight='bold')
-    
-    plt.tight_layout()
+    if USE_MATPLOTLIB_FIGURES:
+        png = _matplotlib_png(consensus_map, title)
+    else:
+        png = _consensus_png(consensus_map, title)
     
     # Convert to base64
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png', dpi=100, bbox_inches='tight')
-    buf.seek(0)
-    img_base64 = base64.b64encode(buf.read()).decode('utf-8')
-    plt.close(fig)
+    img_base64 = base64.b64encode(png).decode('utf-8')
     
     return f"data:image/png;base64,{img_base64}"
 
 
-def compute_compactness_metrics(label_map):
+def compute_compactness_metrics(label_map, per_district=True):
     """
     Compute two compactness metrics for a labeled grid:
       - cut_edges: number of edges where neighboring cells have different labels
       - polsby_popper: dict[label] -> Polsby–Popper score for that district
 
-    label_map: 2D numpy array of district labels
+    label_map: 2D array of district labels, handled as int8 when they fit
+    per_district: set False when only the average is needed; polsby_popper
+                  is then returned as None instead of being built
+    5x5 int8 results are cached by the grid's contents (see _compactness_cached)
     """
-    label_map = np.array(label_map)
-    H, W = label_map.shape
-    labels = np.unique(label_map)
+    label_map = np.asarray(label_map)
+    small = np.ascontiguousarray(label_map, dtype=np.int8)
+    if not np.array_equal(small, label_map):
+        # Labels outside int8 would wrap; score them at full width, uncached
+        cut_edges, pp_items, avg_pp = _compactness_grid(label_map.astype(np.int64), per_district)
+    elif small.shape != (GRID_H, GRID_W):
+        cut_edges, pp_items, avg_pp = _compactness_grid(small, per_district)
+    else:
+        cut_edges, pp_items, avg_pp = _compactness_cached(small.shape, small.tobytes(), per_district)
+    return cut_edges, dict(pp_items) if per_district else None, avg_pp
 
-    # Area and perimeter for each district
-    area = {int(l): 0 for l in labels}
-    perimeter = {int(l): 0 for l in labels}
 
-    cut_edges = 0
+@lru_cache(maxsize=4096)
+def _compactness_cached(shape, raw, per_district):
+    """
+    compute_compactness_metrics for an int8 grid given as (shape, bytes)
+    Returns (cut_edges, ((label, pp), ...) in label order or None, avg_pp)
+    """
+    return _compactness_grid(np.frombuffer(raw, dtype=np.int8).reshape(shape), per_district)
 
-    for r in range(H):
-        for c in range(W):
-            lab = int(label_map[r, c])
-            area[lab] += 1
 
-            
-            # Up
-            if r == 0 or label_map[r - 1, c] != lab:
-                perimeter[lab] += 1
-            # Down
-            if r == H - 1 or label_map[r + 1, c] != lab:
-                perimeter[lab] += 1
-            # Left
-            if c == 0 or label_map[r, c - 1] != lab:
-                perimeter[lab] += 1
-            # Right
-            if c == W - 1 or label_map[r, c + 1] != lab:
-                perimeter[lab] += 1
-
-            # --- cut edges (only count each interior edge once) ---
-            if c + 1 < W and label_map[r, c] != label_map[r, c + 1]:
-                cut_edges += 1
-            if r + 1 < H and label_map[r, c] != label_map[r + 1, c]:
-                cut_edges += 1
+def _compactness_grid(label_map, per_district):
+    """_compactness_cached's result for an integer ndarray, without the cache"""
+    # Compact labels to 0..K-1 so bincount accepts negative labels
+    labels, codes = np.unique(label_map, return_inverse=True)
+    codes = codes.reshape(label_map.shape)
+
+    # --- cut edges (each interior edge compared once via shifted copies) ---
+    hcut = label_map[:, :-1] != label_map[:, 1:]
+    vcut = label_map[:-1, :] != label_map[1:, :]
+    cut_edges = int(hcut.sum() + vcut.sum())
+
+    # --- perimeter: edges where the neighbor differs or is off the grid ---
+    padded = np.pad(codes, 1, constant_values=-1)
+    center = padded[1:-1, 1:-1]
+    perim_per_cell = ((center != padded[:-2, 1:-1]).astype(int)   # Up
+                      + (center != padded[2:, 1:-1])              # Down
+                      + (center != padded[1:-1, :-2])             # Left
+                      + (center != padded[1:-1, 2:]))             # Right
+
+    # Area and perimeter for each district (indexed by code)
+    area = np.bincount(codes.ravel())
+    perimeter = np.bincount(codes.ravel(), weights=perim_per_cell.ravel())
 
     # Polsby–Popper for each district
-    polsby_popper = {}
-    for lab in labels:
-        lab = int(lab)
-        A = area[lab]
-        P = perimeter[lab]
-        if P > 0:
-            polsby_popper[lab] = 4.0 * np.pi * A / (P ** 2)
-        else:
-            polsby_popper[lab] = 0.0
+    pp = 4.0 * np.pi * area / np.where(perimeter > 0, perimeter ** 2, 1)
+    pp_arr = np.where(perimeter > 0, pp, 0.0)
 
     # Also return an overall average PP
-    avg_pp = float(np.mean(list(polsby_popper.values())))
+    avg_pp = float(pp_arr.mean())
+
+    polsby_popper = None
+    if per_district:
+        polsby_popper = tuple(zip(labels.tolist(), pp_arr.tolist()))
 
     return cut_edges, polsby_popper, avg_pp
 
@@ -288,13 +564,28 @@ def get_compactness_report(label_map):
 def rank_plans_by_compactness(plans):
     """
     Rank plans by compactness metrics
+    Uses each plan's precomputed 'cut_edges'/'avg_pp' when present
+    (as stored in the database), otherwise scores its 'districts'
     Returns list of dicts with rankings
     """
     results = []
     
+    # Score every plan without stored metrics in one compiled batch
+    missing = [idx for idx, plan in enumerate(plans)
+               if plan.get('cut_edges') is None or plan.get('avg_pp') is None]
+    scored = {}
+    if missing:
+        stacked = np.stack([np.asarray(plans[idx]['districts']) for idx in missing])
+        # Compact labels to 0..K-1 so the kernel can index by them directly
+        labels, codes = np.unique(stacked, return_inverse=True)
+        cut_arr, pp_arr = _compactness_all(codes.reshape(stacked.shape), len(labels))
+        scored = dict(zip(missing, zip(cut_arr.tolist(), pp_arr.tolist())))
+    
     for idx, plan in enumerate(plans):
-        plan_array = np.array(plan['districts'])
-        cut_edges, pp_scores, avg_pp = compute_compactness_metrics(plan_array)
+        if idx in scored:
+            cut_edges, avg_pp = scored[idx]
+        else:
+            cut_edges, avg_pp = plan['cut_edges'], plan['avg_pp']
         
         results.append({
             'id': plan['id'],
@@ -305,10 +596,65 @@ def rank_plans_by_compactness(plans):
             'avg_pp': round(avg_pp, 3)
         })
     
-    # Sort by avg PP (descending) and then cut edges (ascending)
-    results_sorted = sorted(
-        results,
-        key=lambda d: (-d["avg_pp"], d["cut_edges"])
-    )
+    # Sort by avg PP (descending) and then cut edges (ascending); lexsort is
+    # stable, so ties keep the input order just like sorted() did
+    cut_keys = np.array([r['cut_edges'] for r in results], dtype=np.int64)
+    pp_keys = np.array([r['avg_pp'] for r in results], dtype=np.float64)
+    order = np.lexsort((cut_keys, -pp_keys))
+    
+    return [results[i] for i in order.tolist()]
+
+
+@njit(cache=True)
+def _compactness_all(plans_arr, n_labels):
+    """
+    Cut edges and average Polsby–Popper for a stack of plans in one kernel
+    plans_arr: (n_plans, H, W) integer array of label codes in 0..n_labels-1
+               (compacted with np.unique; raw labels are not bounds-checked)
+    Returns (cut_edges[n_plans], avg_pp[n_plans]), matching
+    compute_compactness_metrics plan by plan
+    """
+    n_plans, H, W = plans_arr.shape
+    cut_edges = np.zeros(n_plans, dtype=np.int64)
+    avg_pp = np.zeros(n_plans, dtype=np.float64)
+    
+    for i in range(n_plans):
+        plan = plans_arr[i]
+        area = np.zeros(n_labels, dtype=np.int64)
+        perimeter = np.zeros(n_labels, dtype=np.int64)
+        cuts = 0
+        
+        for r in range(H):
+            for c in range(W):
+                lab = plan[r, c]
+                area[lab] += 1
+                
+                # --- perimeter contributions (4-neighborhood) ---
+                if r == 0 or plan[r - 1, c] != lab:
+                    perimeter[lab] += 1
+                if r == H - 1 or plan[r + 1, c] != lab:
+                    perimeter[lab] += 1
+                if c == 0 or plan[r, c - 1] != lab:
+                    perimeter[lab] += 1
+                if c == W - 1 or plan[r, c + 1] != lab:
+                    perimeter[lab] += 1
+                
+                # --- cut edges (only count each interior edge once) ---
+                if c + 1 < W and plan[r, c + 1] != lab:
+                    cuts += 1
+                if r + 1 < H and plan[r + 1, c] != lab:
+                    cuts += 1
+        
+        # Average Polsby–Popper over the districts present
+        total = 0.0
+        count = 0
+        for lab in range(n_labels):
+            if area[lab] > 0:
+                if perimeter[lab] > 0:
+                    total += 4.0 * np.pi * area[lab] / (perimeter[lab] ** 2)
+                count += 1
+        
+        cut_edges[i] = cuts
+        avg_pp[i] = total / count
     
-    return results_sorted
\ No newline at end of file
+    return cut_edges, avg_pp